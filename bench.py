@@ -0,0 +1,138 @@
+"""
+Local benchmarks, no Discord or OpenAI credentials are needed.
+
+workers: throughput of running jobs in the gateway itself, and in worker processes. Jobs wait for a while without
+blocking, like an OpenAI call. Every worker runs up to concurrency jobs at once, so throughput grows with the number
+of workers until the workers can run all jobs at once.
+logging: time spent on the request path logging a conversation, printing it versus queueing it.
+
+Usage: python bench.py workers [jobs] [latency seconds] [concurrency per worker]
+       python bench.py logging [events]
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+from jobqueue import WORKER_CONCURRENCY, LocalBroker, SocketBroker, run_worker
+from logs import log_event, setup_logging
+from settings import LOG_SAMPLE_RATES, MAX_HISTORY_TOKENS
+
+WORKER_COUNTS = (1, 2, 4, 8)
+CONVERSATION_SIZES = (MAX_HISTORY_TOKENS // 4, MAX_HISTORY_TOKENS, MAX_HISTORY_TOKENS * 4)
+
+
+def fake_handler(latency):
+    async def handler(job):
+        await asyncio.sleep(latency)
+        return job['args']['text']
+    return handler
+
+
+def worker_process(path, latency, concurrency):
+    asyncio.run(run_worker(path, fake_handler(latency), concurrency))
+
+
+async def run_jobs(broker, jobs):
+    """
+    Returns jobs per second
+    """
+    start = time.perf_counter()
+    await asyncio.gather(*[broker.submit({'kind': 'prompt', 'args': {'text': str(i)}}) for i in range(jobs)])
+    return jobs / (time.perf_counter() - start)
+
+
+async def bench_local(jobs, latency):
+    return await run_jobs(LocalBroker(fake_handler(latency)), jobs)
+
+
+async def bench_workers(path, workers, jobs, latency, concurrency):
+    broker = SocketBroker(path)
+    await broker.start()
+    processes = [
+        multiprocessing.Process(target=worker_process, args=(path, latency, concurrency)) for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        while len(broker.workers) < workers:
+            await asyncio.sleep(0.01)
+        # Warm up, so every worker has handled a job before timing starts
+        await asyncio.gather(*[broker.submit({'kind': 'prompt', 'args': {'text': ''}}) for _ in range(workers)])
+        return await run_jobs(broker, jobs)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        await broker.close()
+
+
+def main_workers(jobs=200, latency=0.05, concurrency=WORKER_CONCURRENCY):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sock')
+    print(f'{jobs} jobs, {latency * 1000:.0f} ms per job, {concurrency} jobs at once per worker')
+    print(f'in the gateway: {asyncio.run(bench_local(jobs, latency)):.1f} jobs/s')
+    for workers in WORKER_COUNTS:
+        throughput = asyncio.run(bench_workers(path, workers, jobs, latency, concurrency))
+        print(f'{workers} workers: {throughput:.1f} jobs/s')
+
+
+def bench_print(path, events, conversation):
+    """
+    Returns microseconds per event of printing the conversation, like prompt() used to
+    """
+    with open(path, 'w', buffering=1) as f:
+        start = time.perf_counter()
+        for _ in range(events):
+            print(conversation, file=f)
+        return (time.perf_counter() - start) / events * 1e6
+
+
+def bench_log_event(path, events, conversation, level, sample_rates):
+    """
+    Returns microseconds per event spent on the calling thread, and the seconds the background thread needed to catch up
+    """
+    with open(path, 'w', buffering=1) as f, patch.dict(LOG_SAMPLE_RATES, sample_rates):
+        listener = setup_logging(level, f)
+        start = time.perf_counter()
+        for _ in range(events):
+            log_event('conversation', logging.DEBUG, conversation=conversation)
+        hot_path = (time.perf_counter() - start) / events * 1e6
+        start = time.perf_counter()
+        listener.stop()
+        return hot_path, time.perf_counter() - start
+
+
+def main_logging(events=5000):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.log')
+    print(f'{events} events')
+    for size in CONVERSATION_SIZES:
+        conversation = ('User: Hello bot\nAI: Hello human\n' * size)[:size]
+        print(f'{size} character conversation')
+        print(f'  print: {bench_print(path, events, conversation):.1f} us/event')
+        for name, level, sample_rates in [
+            ('log_event, all logged', 'DEBUG', {'conversation': 1.0}),
+            ('log_event, default sampling', 'DEBUG', {}),
+            ('log_event, level disabled', 'INFO', {}),
+        ]:
+            hot_path, drain = bench_log_event(path, events, conversation, level, sample_rates)
+            print(f'  {name}: {hot_path:.1f} us/event, background thread done {drain * 1000:.0f} ms later')
+
+
+def main():
+    benchmark = sys.argv[1] if len(sys.argv) > 1 else 'workers'
+    args = sys.argv[2:]
+    if benchmark == 'workers':
+        jobs, latency, concurrency = args[:1], args[1:2], args[2:3]
+        main_workers(*[int(arg) for arg in jobs], *[float(arg) for arg in latency], *[int(arg) for arg in concurrency])
+    elif benchmark == 'logging':
+        main_logging(*[int(arg) for arg in args[:1]])
+    else:
+        print(__doc__)
+
+
+if __name__ == "__main__":
+    main()
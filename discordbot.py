@@ -1,54 +1,100 @@
+import asyncio
 from collections import defaultdict
+import logging
 import os
+import re
 
 import discord
 from discord.ext import commands
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 
+from jobqueue import WORKER_CONCURRENCY as DEFAULT_WORKER_CONCURRENCY, LocalBroker, SocketBroker, run_worker
+from logs import log_event, setup_logging
+from profiling import SlowCallbackDetector, profile
 from settings import (
-    DALL_E_MODEL, GPT_MODEL,
-    MAX_DISCORD_TOKENS, MAX_HISTORY_TOKENS, MAX_OPENAI_TOKENS,
+    DALL_E_MODEL, GPT_MODEL, JOB_SOCKET_PATH,
+    MAX_CONCURRENT_IMAGES, MAX_DISCORD_TOKENS, MAX_HISTORY_TOKENS, MAX_IMAGES, MAX_OPENAI_TOKENS, MAX_PROFILE_SECONDS,
+    PROFILE_DIR,
 )
 
 load_dotenv()
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+BOT_MODE = os.getenv('BOT_MODE', 'standalone')  # standalone, gateway or worker
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', DEFAULT_WORKER_CONCURRENCY))  # Jobs a worker runs at once
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# Without the message content intent, guilds can only use slash commands, DMs keep working with ! commands
+MESSAGE_CONTENT_INTENT = os.getenv('MESSAGE_CONTENT_INTENT', '1') == '1'
+PROFILE_SECONDS = float(os.getenv('PROFILE_SECONDS', 0))  # Profile this many seconds after startup
+SLOW_CALLBACK_SECONDS = float(os.getenv('SLOW_CALLBACK_SECONDS', 0))  # Report callbacks blocking the loop this long
+# Registering slash commands with Discord is rate limited, only do it when they changed
+SYNC_COMMANDS = os.getenv('SYNC_COMMANDS', '0') == '1'
+IMAGE_COUNT = re.compile(r'x(\d+)\s+(.*)', re.DOTALL)  # !image x3 <search terms>, numbers alone are search terms
 
 intents = discord.Intents.default()
-intents.message_content = True
-intents.messages = True
+intents.message_content = MESSAGE_CONTENT_INTENT
+# Guild messages are empty without message content, don't receive them at all
+intents.guild_messages = MESSAGE_CONTENT_INTENT
+intents.dm_messages = True
 
 bot = commands.Bot(command_prefix='!', intents=intents)
-client = OpenAI(api_key=OPENAI_API_KEY, max_retries=2)
+# The gateway hands all OpenAI calls to the workers, and doesn't need an API key
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=2) if BOT_MODE != 'gateway' else None
 
 bot.temperature = 0.7  # Set default temperature
 bot.max_tokens = MAX_OPENAI_TOKENS  # Set default max_tokens
 bot.max_history_tokens = MAX_HISTORY_TOKENS
 bot.conversation_history = defaultdict(str)
 bot.role = "Discord bot"
+bot.image_slots = asyncio.Semaphore(MAX_CONCURRENT_IMAGES)  # Limits image generations across all users
+bot.in_flight = {}  # The tasks of the prompts being answered, by user and message
+bot.in_flight_users = {}  # The user of every message in in_flight, so a deleted message is found right away
+
+
+async def start_diagnostics():
+    """
+    Start the profiler and slow callback detector if they're switched on in the environment
+    """
+    if SLOW_CALLBACK_SECONDS:
+        bot.slow_callback_detector = SlowCallbackDetector(asyncio.get_running_loop(), SLOW_CALLBACK_SECONDS)
+        bot.slow_callback_detector.start()
+    if PROFILE_SECONDS:
+        bot.startup_profile = asyncio.create_task(profile(PROFILE_SECONDS, PROFILE_DIR))
+        # profile() logs its outcome, retrieve a failure so asyncio doesn't report it again
+        bot.startup_profile.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+
+@bot.event
+async def setup_hook():
+    await start_diagnostics()
+    await bot.broker.start()
+    if SYNC_COMMANDS:
+        await bot.tree.sync()
 
 
 @bot.event
 async def on_ready():
-    print(f'{bot.user} has connected to Discord!')
+    log_event('connected', user=str(bot.user))
 
 
 def is_valid_input(text: str) -> bool:
     return len(text) <= 4096  # Discord message character limit
 
 
-async def call_openai_api(prompt_text, max_tokens, temperature):
+async def call_openai_api(prompt_text, max_tokens, temperature, role=None):
+    if role is None:
+        role = bot.role
     messages = [
-        {"role": "system", "content": f"Your role is {bot.role}. You will never explicitly state your role. "
+        {"role": "system", "content": f"Your role is {role}. You will never explicitly state your role. "
                                       f"You will never start a sentence with As a or As an. "
                                       f"You will never admit to being an AI. You are convinced you are human. "
                                       f"You will never use a phrase like as a language model AI. "},
         {"role": "user", "content": prompt_text}]
     try:
 
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=GPT_MODEL,
             messages=messages,
             max_tokens=max_tokens,
@@ -59,7 +105,7 @@ async def call_openai_api(prompt_text, max_tokens, temperature):
         if response and response.choices:
             return response.choices[0].message.content.strip()
     except Exception as e:
-        print(f"An unexpected error occurred: {str(e)}")
+        log_event('openai_error', logging.ERROR, error=str(e))
         raise
 
 
@@ -68,7 +114,7 @@ async def get_openai_image(search_term):
     Fetch an image using the OpenAI API
     Takes a search term and returns an url
     """
-    response = client.images.generate(
+    response = await client.images.generate(
         model=DALL_E_MODEL,
         prompt=search_term,
         n=1,
@@ -79,16 +125,27 @@ async def get_openai_image(search_term):
     return response.data[0].url
 
 
+async def complete(prompt_text, max_tokens, temperature):
+    """
+    call_openai_api() with the bot's current role, run by the broker so the gateway doesn't talk to OpenAI itself
+    """
+    return await bot.broker.submit({
+        'kind': 'complete',
+        'args': {'prompt_text': prompt_text, 'max_tokens': max_tokens, 'temperature': temperature, 'role': bot.role},
+    })
+
+
 async def send_image(ctx, search_term):
     try:
-        image_url = await get_openai_image(search_term)
+        async with bot.image_slots:
+            image_url = await bot.broker.submit({'kind': 'image', 'args': {'search_term': search_term}})
 
         embed = discord.Embed()
         embed.set_image(url=image_url)
         await ctx.send(embed=embed)
         return
     except Exception as e:
-        print(f"An unexpected error occurred: {str(e)}")
+        log_event('image_error', logging.ERROR, search_term=search_term, error=str(e))
         raise e
 
 
@@ -106,24 +163,57 @@ async def on_message(message):
     await bot.process_commands(message)
 
 
-@bot.command(name='image',
-             help='Ask the bot to send a random image. Usage: image [random|<search terms>]')
+@bot.event
+async def on_raw_message_delete(payload):
+    # Nobody is waiting for the answer to a deleted prompt anymore
+    cancel_message_request(payload.message_id)
+
+
+async def send_images(ctx, search_terms):
+    """
+    Generate the images concurrently, and send each one as soon as it's done.
+    Failed images don't stop the others, they're reported at the end
+    """
+    results = await asyncio.gather(*[send_image(ctx, search_term) for search_term in search_terms],
+                                   return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        await ctx.send(f"Couldn't send {len(errors)} of {len(search_terms)} images: {errors[0]}")
+
+
+@bot.hybrid_command(name='image',
+                    help='Ask the bot to send images. Usage: image [xN] random|<search terms> [| style | style ...]')
 async def image(ctx, *, prompt):
     """
     If method openai specified, let the AI choose the search terms,
-    otherwise use what the user supplied as search terms
+    otherwise use what the user supplied as search terms.
+    Styles separated by | each get an image, a leading xN asks for N images that cycle through them
     """
+    await ctx.defer()
     try:
-        if prompt == 'random':
-            search_term = await call_openai_api(
+        count = None
+        if match := IMAGE_COUNT.fullmatch(prompt):
+            count, prompt = int(match[1]), match[2]
+        search_term, *styles = [part.strip() for part in prompt.split('|')]
+        styles = [style for style in styles if style]
+        if count is None:
+            count = max(len(styles), 1)
+        if not 1 <= count <= MAX_IMAGES:
+            await ctx.send(f"Invalid number of images. Please enter an integer between 1 and {MAX_IMAGES}.")
+            return
+
+        if search_term == 'random':
+            search_term = await complete(
                 prompt_text=f'short phrase that describes your role: {bot.role}',
                 max_tokens=4096,
                 temperature=bot.temperature,
             )
             await ctx.send(search_term)
+        if styles:
+            search_terms = [f'{search_term}, {styles[i % len(styles)]}' for i in range(count)]
         else:
-            search_term = prompt
-        await send_image(ctx, search_term)
+            search_terms = [search_term] * count
+        await send_images(ctx, search_terms)
     except Exception as e:
         await ctx.send(f"Couldn't send random gif: {e}")
 
@@ -140,29 +230,32 @@ async def random_role(ctx):
 
 async def set_random_role():
     try:
-        description = await call_openai_api(
+        description = await complete(
             prompt_text='In a short sentence make up a random role an AI chatbot could play',
             max_tokens=4096,
             temperature=bot.temperature,
         )
         bot.role = description
+        log_event('role', role=description)
         return description
     except Exception as e:
-        print(f"Couldn't set random role: {e}")
+        log_event('role_error', logging.ERROR, error=str(e))
 
 
-async def summarize_conversation(conversation: str) -> str:
+async def summarize_conversation(conversation: str, role=None) -> str:
     summary = await call_openai_api(
         prompt_text=f"Summarize the following conversation:\n{conversation}",
         max_tokens=1000,
         temperature=0.7,
+        role=role,
     )
-    print("Summary", summary)
+    log_event('summary', logging.DEBUG, summary=summary)
     return summary
 
 
-@bot.command(name='tokens', help='Set the max number of tokens generated')
+@bot.hybrid_command(name='tokens', help='Set the max number of tokens generated')
 async def set_max_tokens(ctx, tokens: int):
+    await ctx.defer()
     if 1 <= tokens <= 4096:  # Reasonable range for max_tokens
         bot.max_tokens = tokens
         await ctx.send(f"Max tokens set to {tokens}.")
@@ -170,8 +263,9 @@ async def set_max_tokens(ctx, tokens: int):
         await ctx.send("Invalid max tokens value. Please enter an integer between 1 and 4096.")
 
 
-@bot.command(name='role', help='Set the role the bot will play')
+@bot.hybrid_command(name='role', help='Set the role the bot will play')
 async def set_role(ctx, *, role="random"):
+    await ctx.defer()
     await clear_history(ctx)
     if role == "random":
         description = await set_random_role()
@@ -181,8 +275,9 @@ async def set_role(ctx, *, role="random"):
         await ctx.send(f"Role set to {role}.")
 
 
-@bot.command(name='temp', help='Set the temperature (0.0 - 1.0), which sets the emotional tone')
+@bot.hybrid_command(name='temp', help='Set the temperature (0.0 - 1.0), which sets the emotional tone')
 async def set_temperature(ctx, temp: float):
+    await ctx.defer()
     if 0 <= temp <= 1:
         bot.temperature = temp
         await ctx.send(f"Temperature set to {temp}.")
@@ -190,51 +285,143 @@ async def set_temperature(ctx, temp: float):
         await ctx.send("Invalid temperature value. Please enter a value between 0 and 1.")
 
 
+def track_request(user_id, message_id, task):
+    bot.in_flight.setdefault(user_id, {})[message_id] = task
+    bot.in_flight_users[message_id] = user_id
+
+
+def untrack_request(message_id):
+    """
+    Stop tracking the prompt in a message, returns its task or None if it wasn't tracked
+    """
+    user_id = bot.in_flight_users.pop(message_id, None)
+    if user_id is None:
+        return None
+    requests = bot.in_flight[user_id]
+    task = requests.pop(message_id)
+    if not requests:
+        del bot.in_flight[user_id]
+    return task
+
+
+def cancel_requests(user_id):
+    """
+    Cancel the prompts of a user that are still being answered. Cancelling raises CancelledError in the prompt
+    where it waits for the answer, so it never gets written to the history, and closes the connection to OpenAI
+    """
+    for message_id, task in bot.in_flight.pop(user_id, {}).items():
+        del bot.in_flight_users[message_id]
+        task.cancel()
+
+
+def cancel_message_request(message_id):
+    task = untrack_request(message_id)
+    if task:
+        task.cancel()
+
+
 async def clear_history(ctx):
     user_id = str(ctx.message.author.id)
+    cancel_requests(user_id)
     bot.conversation_history[user_id] = ''
 
 
-@bot.command(name='forget', help='Clear the chat history')
+@bot.hybrid_command(name='forget', help='Clear the chat history')
 async def forget(ctx):
+    await ctx.defer()
     await clear_history(ctx)
     await ctx.send('Your conversation history has been cleared.')
 
 
-@bot.command(name='summarize', help='Summarize the chat history')
+@bot.hybrid_command(name='summarize', help='Summarize the chat history')
 async def summarize_history(ctx):
+    await ctx.defer()
     try:
         user_id = str(ctx.message.author.id)
-        summary = await summarize_conversation(bot.conversation_history[user_id])
+        summary = await bot.broker.submit({
+            'kind': 'summarize',
+            'args': {'conversation': bot.conversation_history[user_id], 'role': bot.role},
+        })
         await ctx.send(summary)
     except Exception as e:
         await ctx.send(f"An unexpected error occurred: {e}")
 
 
-@bot.command(name='prompt', help='Provide the prompt for OpenAI to start riffing on')
+async def generate_answer(text, conversation, role, max_tokens, temperature, max_history_tokens):
+    """
+    Continue the conversation with text, summarizing it first if it got too long.
+    Returns the answer and the new conversation
+    """
+    if len(conversation) > max_history_tokens:
+        conversation = await summarize_conversation(conversation, role=role)
+        log_event('summarized_history', logging.DEBUG, length=len(conversation))
+
+    conversation += f"User: {text}\nAI:"
+    log_event('conversation', logging.DEBUG, conversation=conversation)
+
+    answer = await call_openai_api(
+        prompt_text=conversation,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        role=role,
+    )
+    conversation += f" {answer}\n"
+    return {'answer': answer, 'conversation': conversation}
+
+
+async def run_job(job):
+    """
+    Run a job submitted by the gateway, in the gateway itself or in a worker process
+    """
+    args = job['args']
+    if job['kind'] == 'prompt':
+        return await generate_answer(**args)
+    if job['kind'] == 'image':
+        return await get_openai_image(args['search_term'])
+    if job['kind'] == 'summarize':
+        return await summarize_conversation(args['conversation'], role=args['role'])
+    if job['kind'] == 'complete':
+        return await call_openai_api(**args)
+    raise ValueError(f"Unknown job kind {job['kind']}")
+
+
+bot.broker = LocalBroker(run_job)
+
+
+@bot.hybrid_command(name='prompt', help='Provide the prompt for OpenAI to start riffing on')
 async def prompt(ctx, *, text):
+    await ctx.defer()
     try:
         user_id = str(ctx.message.author.id)
-        if len(bot.conversation_history[user_id]) > bot.max_history_tokens:
-            conversation = await summarize_conversation(bot.conversation_history[user_id])
-            print(f'Summarizing long history: {conversation}')
-        else:
-            conversation = bot.conversation_history[user_id]
-
         if not is_valid_input(text):
             await ctx.send("Invalid input. Please make sure the text is within the character limit.")
             return
 
-        conversation += f"User: {text}\nAI:"
-        print(conversation)
-
-        answer = await call_openai_api(
-            prompt_text=conversation,
-            max_tokens=bot.max_tokens,
-            temperature=bot.temperature,
-        )
-        conversation += f" {answer}\n"
-        bot.conversation_history[user_id] = conversation
+        # A new prompt supersedes the ones still being answered
+        cancel_requests(user_id)
+        track_request(user_id, ctx.message.id, asyncio.current_task())
+        try:
+            result = await bot.broker.submit({
+                'kind': 'prompt',
+                'args': {
+                    'text': text,
+                    'conversation': bot.conversation_history[user_id],
+                    'role': bot.role,
+                    'max_tokens': bot.max_tokens,
+                    'temperature': bot.temperature,
+                    'max_history_tokens': bot.max_history_tokens,
+                },
+            })
+        except asyncio.CancelledError:
+            if ctx.interaction:
+                # Otherwise the deferred slash command shows the bot thinking until the interaction expires
+                await ctx.send("This prompt was cancelled.")
+            raise
+        finally:
+            # Once the answer is in the history it's no longer stale, let it be sent in full
+            untrack_request(ctx.message.id)
+        answer = result['answer']
+        bot.conversation_history[user_id] = result['conversation']
 
         # If answer is longer than Discord limit, send it in chunks
         i = 0
@@ -245,6 +432,17 @@ async def prompt(ctx, *, text):
         await ctx.send(f"An unexpected error occurred: {e}")
 
 
+@bot.command(name='profile', help='Profile the bot for a number of seconds. Only for the owner of the bot')
+@commands.is_owner()
+async def profile_bot(ctx, seconds: float):
+    if 0 < seconds <= MAX_PROFILE_SECONDS:
+        await ctx.send(f"Profiling for {seconds} seconds.")
+        path = await profile(seconds, PROFILE_DIR)
+        await ctx.send(f"Profile written to {path}.")
+    else:
+        await ctx.send(f"Invalid number of seconds. Please enter a value between 0 and {MAX_PROFILE_SECONDS}.")
+
+
 @bot.event
 async def on_command_error(ctx, error):
     if isinstance(error, commands.CommandNotFound):
@@ -253,12 +451,28 @@ async def on_command_error(ctx, error):
         await ctx.send("A required argument is missing. Please check your command and try again.")
     elif isinstance(error, commands.BadArgument):
         await ctx.send("Invalid argument provided. Please check your input and try again.")
+    elif isinstance(error, commands.NotOwner):
+        await ctx.send("Only the owner of the bot can use this command.")
     else:
         await ctx.send(f"An error occurred while processing your command. Please try again later. {error}")
 
 
+async def worker():
+    await start_diagnostics()
+    await run_worker(JOB_SOCKET_PATH, run_job, WORKER_CONCURRENCY)
+
+
 def main():
-    bot.run(DISCORD_TOKEN)
+    listener = setup_logging(LOG_LEVEL)
+    try:
+        if BOT_MODE == 'worker':
+            asyncio.run(worker())
+            return
+        if BOT_MODE == 'gateway':
+            bot.broker = SocketBroker(JOB_SOCKET_PATH)
+        bot.run(DISCORD_TOKEN, log_handler=None)
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":
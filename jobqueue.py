@@ -0,0 +1,230 @@
+"""
+Job queue between the gateway process, which talks to Discord, and the worker processes, which talk to OpenAI.
+
+A job is a JSON-serializable dict of the form {'kind': ..., 'args': {...}}. The gateway submits jobs to a broker,
+which hands them to a handler and returns the handler's result.
+LocalBroker runs the handler in the gateway process itself. This is the default.
+SocketBroker listens on a Unix socket and hands jobs to worker processes started with run_worker().
+Cancelling a submitted job cancels it in the worker as well.
+"""
+import asyncio
+import itertools
+import json
+import os
+
+MAX_MESSAGE_SIZE = 2 ** 20  # Longest line read from the socket
+RECONNECT_DELAY = 1.0  # Seconds a worker waits before reconnecting to the gateway
+WORKER_CONCURRENCY = 16  # Jobs a worker runs at once, they mostly wait for OpenAI
+
+
+class JobError(Exception):
+    """
+    Raised in the gateway when a worker failed to run a job
+    """
+
+
+async def read_message(reader):
+    """
+    Read a newline delimited JSON message, returns None when the connection was closed
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+async def write_message(writer, message):
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+
+
+class LocalBroker:
+    """
+    Runs jobs in the gateway process
+    """
+    def __init__(self, handler):
+        self.handler = handler
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def submit(self, job):
+        return await self.handler(job)
+
+
+class SocketBroker:
+    """
+    Hands jobs to worker processes connected to a Unix socket.
+    A worker says how many jobs it runs at once when it connects, and never gets more than that in flight,
+    so busy workers don't get new jobs while idle workers wait.
+    Jobs fail with JobError when no workers are connected, instead of waiting for one.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.queue = asyncio.Queue()
+        self.server = None
+        self.connections = set()
+        self.workers = set()  # Connections that said hello
+        self.job_ids = itertools.count()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.serve_worker, path=self.path, limit=MAX_MESSAGE_SIZE)
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            for connection in self.connections:
+                connection.cancel()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+
+    async def submit(self, job):
+        if not self.workers:
+            raise JobError('No workers are connected')
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((next(self.job_ids), job, future))
+        return await future
+
+    async def serve_worker(self, reader, writer):
+        """
+        Feed jobs to a connected worker, up to its concurrency, until it disconnects
+        """
+        connection = asyncio.current_task()
+        self.connections.add(connection)
+        in_flight = {}
+        replies = next_job = None
+        try:
+            hello = await read_message(reader)
+            if hello is None:
+                return
+            slots = asyncio.Semaphore(hello['concurrency'])
+            self.workers.add(connection)
+            replies = asyncio.create_task(self.read_replies(reader, in_flight, slots))
+            while True:
+                next_job = asyncio.ensure_future(self.next_job(slots))
+                await asyncio.wait([next_job, replies], return_when=asyncio.FIRST_COMPLETED)
+                if not next_job.done():
+                    # The worker went away while waiting for a job
+                    return
+                job_id, job, future = next_job.result()
+                if future.done():
+                    # The submitter gave up on this job before a worker got to it
+                    slots.release()
+                    continue
+                in_flight[job_id] = (job, future)
+                future.add_done_callback(lambda future, job_id=job_id: self.cancel_job(writer, in_flight, job_id))
+                await write_message(writer, {'id': job_id, 'job': job})
+        except ConnectionError:
+            pass
+        except asyncio.CancelledError:
+            # The broker is closing. Return normally, asyncio logs cancelled connection handlers as unhandled errors
+            pass
+        finally:
+            for task in (replies, next_job):
+                if task and not task.done():
+                    task.cancel()
+            self.connections.discard(connection)
+            self.workers.discard(connection)
+            writer.close()
+            # Let another worker pick up the jobs this one didn't finish
+            for job_id, (job, future) in in_flight.items():
+                if not future.done():
+                    self.queue.put_nowait((job_id, job, future))
+            if not self.workers:
+                self.fail_queued_jobs()
+
+    def fail_queued_jobs(self):
+        while not self.queue.empty():
+            _, _, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(JobError('No workers are connected'))
+
+    async def next_job(self, slots):
+        await slots.acquire()
+        return await self.queue.get()
+
+    async def read_replies(self, reader, in_flight, slots):
+        """
+        Resolve the futures of the jobs a worker finished, until it disconnects
+        """
+        try:
+            while (reply := await read_message(reader)) is not None:
+                job, future = in_flight.pop(reply['id'], (None, None))
+                if future is None:
+                    continue
+                slots.release()
+                if future.done():
+                    # Cancelled while the worker was running it, drop the result
+                    continue
+                if 'error' in reply:
+                    future.set_exception(JobError(reply['error']))
+                elif 'cancelled' in reply:
+                    future.set_exception(JobError('The worker cancelled the job'))
+                else:
+                    future.set_result(reply['result'])
+        except ConnectionError:
+            pass
+
+    def cancel_job(self, writer, in_flight, job_id):
+        """
+        When the submitter cancels a job the worker is running, tell the worker to cancel it too.
+        It stays in flight until the worker acknowledges that
+        """
+        _, future = in_flight.get(job_id, (None, None))
+        if future and future.cancelled() and not writer.is_closing():
+            writer.write(json.dumps({'cancel': job_id}).encode() + b'\n')
+
+
+async def handle_job(handler, message, writer):
+    """
+    Run a job in a worker and send the result, the error, or that it was cancelled back to the gateway
+    """
+    try:
+        reply = {'id': message['id'], 'result': await handler(message['job'])}
+    except asyncio.CancelledError:
+        reply = {'id': message['id'], 'cancelled': True}
+    except Exception as e:
+        reply = {'id': message['id'], 'error': str(e)}
+    try:
+        await write_message(writer, reply)
+    except ConnectionError:
+        # The gateway went away, it will hand the job to another worker
+        pass
+
+
+async def run_worker(path, handler, concurrency=WORKER_CONCURRENCY):
+    """
+    Connect to the gateway's socket and run up to concurrency of the jobs it sends at once with handler.
+    Keeps reconnecting when the gateway isn't up yet or goes away.
+    """
+    while True:
+        try:
+            reader, writer = await asyncio.open_unix_connection(path, limit=MAX_MESSAGE_SIZE)
+        except (ConnectionError, FileNotFoundError):
+            await asyncio.sleep(RECONNECT_DELAY)
+            continue
+        jobs = {}
+        try:
+            await write_message(writer, {'concurrency': concurrency})
+            while (message := await read_message(reader)) is not None:
+                if 'cancel' in message:
+                    # Cancelling a job that already finished does nothing
+                    if message['cancel'] in jobs:
+                        jobs[message['cancel']].cancel()
+                    continue
+                job = asyncio.create_task(handle_job(handler, message, writer))
+                jobs[message['id']] = job
+                job.add_done_callback(lambda job, job_id=message['id']: jobs.pop(job_id, None))
+        except ConnectionError:
+            pass
+        finally:
+            for job in list(jobs.values()):
+                job.cancel()
+            writer.close()
+        await asyncio.sleep(RECONNECT_DELAY)
@@ -0,0 +1,143 @@
+"""
+Structured logging off the hot path.
+
+log_event() checks the level and the sample rate of the event, and puts the event on a queue as a plain tuple.
+A background thread turns events into records, formats them as JSON lines, truncating large fields, and writes them out.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+
+from settings import LOG_MAX_FIELD_LENGTH, LOG_QUEUE_SIZE, LOG_SAMPLE_RATES
+
+logger = logging.getLogger('discordbot')
+queue_handler = None  # Set while setup_logging() is in effect, log_event() puts events on its queue directly
+
+
+def truncate(value, max_length=LOG_MAX_FIELD_LENGTH):
+    """
+    Shorten long strings, keeping the start and the end, which for stacks and conversations is the interesting part
+    """
+    if not isinstance(value, str) or len(value) <= max_length:
+        return value
+    half = max_length // 2
+    return f'{value[:half]}...[{len(value) - 2 * half} chars]...{value[-half:]}'
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'event': record.getMessage(),
+        }
+        for name, value in getattr(record, 'fields', {}).items():
+            entry[name] = truncate(value)
+        if record.exc_info:
+            entry['exception'] = truncate(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Never blocks and never formats on the calling thread. Drops records when the queue is full
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class QueueListener(logging.handlers.QueueListener):
+    """
+    Stopping it also undoes setup_logging()
+    """
+    def __init__(self, queue_handler, *handlers):
+        super().__init__(queue_handler.queue, *handlers)
+        self.queue_handler = queue_handler
+        self.root_level = logging.getLogger().level
+        self.logger_level = logger.level
+
+    def prepare(self, record):
+        if isinstance(record, tuple):
+            # An event from log_event(), turn it into a record here instead of on the calling thread
+            created, level, event, fields = record
+            record = logger.makeRecord(logger.name, level, '', 0, event, None, None, extra={'fields': fields})
+            record.created = created
+            record.msecs = int((created - int(created)) * 1000) + 0.0
+        return record
+
+    def stop(self):
+        global queue_handler
+        queue_handler = None
+        if self.queue_handler.dropped:
+            # Waits for room like the sentinel, this one mustn't be dropped
+            self.queue.put(logger.makeRecord(
+                logger.name, logging.WARNING, '', 0, 'log_events_dropped', None, None,
+                extra={'fields': {'count': self.queue_handler.dropped}},
+            ))
+        super().stop()
+        root = logging.getLogger()
+        root.removeHandler(self.queue_handler)
+        root.setLevel(self.root_level)
+        logger.setLevel(self.logger_level)
+
+    def enqueue_sentinel(self):
+        # Wait for room in a full queue, so stop() always writes out everything that was queued
+        self.queue.put(self._sentinel)
+
+
+def setup_logging(level='INFO', stream=None):
+    """
+    Send all log records, including discord.py's, through a queue to a background thread that writes them to stream.
+    level applies to the bot's own events, discord.py logs INFO and up, or less when level is higher.
+    Returns the listener, stop it to flush the queue, log how many events were dropped and restore the levels
+    """
+    global queue_handler
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    listener = QueueListener(queue_handler, handler)
+
+    logger.setLevel(level)
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    # discord.py's DEBUG records are every gateway message, they'd crowd the bot's own events out of the queue
+    root.setLevel(max(logging.INFO, logger.level))
+    listener.start()
+    return listener
+
+
+def log_event(event, level=logging.INFO, **fields):
+    """
+    Log an event with fields, if its level is enabled and it's sampled in
+    """
+    if not logger.isEnabledFor(level):
+        return
+    rate = LOG_SAMPLE_RATES.get(event, 1.0)
+    if rate < 1.0 and random.random() >= rate:
+        return
+    # Read once, stop() may clear it from another thread, e.g. while the slow callback detector logs
+    handler = queue_handler
+    if handler is None:
+        # Logging isn't set up, let the logging module handle it
+        logger.handle(logger.makeRecord(logger.name, level, '', 0, event, None, None, extra={'fields': fields}))
+        return
+    # Skips creating a record, the handler's lock and the logger's handler lookup, the listener does that instead
+    try:
+        handler.queue.put_nowait((time.time(), level, event, fields))
+    except queue.Full:
+        handler.dropped += 1
@@ -0,0 +1,132 @@
+"""
+Diagnostics for a live bot process.
+
+SamplingProfiler samples the stacks of all threads from a background thread, and writes them in the collapsed
+format used by flamegraph.pl and speedscope. SlowCallbackDetector watches the event loop from a background thread,
+and logs the stack of whatever blocks the loop for longer than a threshold.
+"""
+import asyncio
+from collections import Counter
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from logs import log_event
+
+SAMPLE_INTERVAL = 0.005  # Seconds between stack samples
+
+
+def collapse_stack(frame, thread_name):
+    """
+    Format a stack as thread;outermost;...;innermost
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+        frame = frame.f_back
+    names.append(thread_name)
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, name='profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != self.thread.ident:
+                    self.stacks[collapse_stack(frame, names.get(thread_id, str(thread_id)))] += 1
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+async def profile(seconds, directory):
+    """
+    Profile the process for a number of seconds, returns the path of the dump.
+    Also logs the path, or why it couldn't be written, for processes that have nobody to send it to
+    """
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'profile-{os.getpid()}-{int(time.time())}.txt')
+        await asyncio.to_thread(profiler.write, path)
+    except OSError as e:
+        log_event('profile_error', logging.ERROR, directory=directory, error=str(e))
+        raise
+    log_event('profile_written', path=path)
+    return path
+
+
+class SlowCallbackDetector:
+    """
+    The event loop updates a heartbeat every threshold / 10 seconds. When the next heartbeat is late by more than
+    threshold, the watchdog thread takes the stack the loop is stuck in, and logs it with how long the loop was stuck
+    once it runs again, or when the detector is stopped.
+    Start it from the thread that runs the loop.
+    """
+    def __init__(self, loop, threshold):
+        self.loop = loop
+        self.threshold = threshold
+        # A short interval keeps both detecting and measuring a stall accurate to within threshold / 10
+        self.interval = threshold / 10
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch, name='slow-callback-detector', daemon=True)
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.loop.call_soon(self.beat)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def beat(self):
+        self.last_beat = time.monotonic()
+        if not self.stopped.is_set():
+            self.loop.call_later(self.interval, self.beat)
+
+    def watch(self):
+        stalled_beat = stack = None
+        while not self.stopped.wait(self.interval):
+            last_beat = self.last_beat
+            if stalled_beat is not None and last_beat != stalled_beat:
+                # The loop runs again, the heartbeat is as late as the loop was stuck
+                self.report(last_beat - (stalled_beat + self.interval), stack)
+                stalled_beat = None
+            if stalled_beat is None and time.monotonic() - (last_beat + self.interval) > self.threshold:
+                stalled_beat = last_beat
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = ''.join(traceback.format_stack(frame)) if frame else ''
+        if stalled_beat is not None:
+            self.report(time.monotonic() - (stalled_beat + self.interval), stack)
+
+    def report(self, seconds, stack):
+        log_event('slow_callback', logging.WARNING, seconds=round(seconds, 3), stack=stack)
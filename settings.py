@@ -3,3 +3,11 @@ DALL_E_MODEL = "dall-e-3"
 MAX_HISTORY_TOKENS = 4096
 MAX_DISCORD_TOKENS = 2000
 MAX_OPENAI_TOKENS = 2000
+JOB_SOCKET_PATH = "/tmp/discordbot.sock"
+PROFILE_DIR = "profiles"
+MAX_PROFILE_SECONDS = 300
+MAX_IMAGES = 4  # Per !image command
+MAX_CONCURRENT_IMAGES = 4  # Across all users
+LOG_MAX_FIELD_LENGTH = 1000  # Longer log fields are truncated
+LOG_QUEUE_SIZE = 10000  # Log events are dropped when the queue is full
+LOG_SAMPLE_RATES = {"conversation": 0.1, "summary": 0.1}  # Fraction of these events that gets logged
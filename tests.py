@@ -1,3 +1,9 @@
+import asyncio
+import io
+import json
+import logging
+import os
+import time
 from unittest.mock import MagicMock, patch
 
 import asynctest
@@ -7,6 +13,9 @@ from discord.ext import commands
 from openai.types import Image, ImagesResponse
 import pytest
 
+from jobqueue import JobError, LocalBroker, SocketBroker, run_worker
+from logs import JsonFormatter, log_event, setup_logging, truncate
+from profiling import SamplingProfiler, SlowCallbackDetector, profile
 from discordbot import (
     bot,
     is_valid_input,
@@ -17,14 +26,19 @@ from discordbot import (
     image,
     main,
     on_command_error,
+    on_raw_message_delete,
     on_ready,
+    profile_bot,
     prompt,
     random_role,
+    run_job,
     send_image,
+    send_images,
     set_max_tokens,
     set_random_role,
     set_role,
     set_temperature,
+    setup_hook,
     summarize_conversation,
     summarize_history,
     on_message
@@ -40,7 +54,7 @@ async def test_call_openai_api():
     call_openai_api() should call openai.Completion.create with prompt_text, max_tokens, and temperature,
     and return the response text
     """
-    with patch('discordbot.client.chat.completions.create') as mock_create:
+    with asynctest.patch('discordbot.client.chat.completions.create', new=CoroutineMock()) as mock_create:
         mock_choice = MagicMock()
         mock_choice.message.content = 'Test response'
         mock_create.return_value.choices = [mock_choice]
@@ -91,7 +105,7 @@ async def test_forget(mock_context_send, mock_clear_history, ctx):
 
 
 @pytest.mark.asyncio
-@patch('discordbot.client.images.generate', autospec=True)
+@asynctest.patch('discordbot.client.images.generate', new_callable=CoroutineMock)
 async def test_get_openai_image(mock_image_create):
     """
     get_openai_image() should call openai.Image.create() with a search_term
@@ -149,14 +163,17 @@ def test_is_valid_input():
     assert not is_valid_input('a' * 4097)
 
 
+@patch('discordbot.setup_logging', autospec=True)
 @patch('discordbot.bot.run', autospec=True)
 @patch('discordbot.DISCORD_TOKEN', '123')
-def test_main(mock_run):
+def test_main(mock_run, mock_setup_logging):
     """
-    main() should call bot.run()
+    main() should set up logging, call bot.run() without discord.py's log handler, and flush the logs at the end
     """
     main()
-    mock_run.assert_called_once_with('123')
+    mock_setup_logging.assert_called_once()
+    mock_run.assert_called_once_with('123', log_handler=None)
+    mock_setup_logging.return_value.stop.assert_called_once()
 
 
 @pytest.mark.asyncio
@@ -179,6 +196,10 @@ async def test_on_command_error(mock_context_send, ctx):
     mock_context_send.assert_called_with(ctx, 'Invalid argument provided. Please check your input and try again.')
     mock_context_send.reset_mock()
 
+    await on_command_error(ctx, commands.NotOwner())
+    mock_context_send.assert_called_with(ctx, 'Only the owner of the bot can use this command.')
+    mock_context_send.reset_mock()
+
     await on_command_error(ctx, Exception('Oh noes!'))
     mock_context_send.assert_called_with(
         ctx, 'An error occurred while processing your command. Please try again later. Oh noes!'
@@ -187,13 +208,13 @@ async def test_on_command_error(mock_context_send, ctx):
 
 
 @pytest.mark.asyncio
-@patch('builtins.print')
-async def test_on_ready(mock_print):
+@patch('discordbot.log_event', autospec=True)
+async def test_on_ready(mock_log_event):
     """
-    on_ready() should print something
+    on_ready() should log something
     """
     await on_ready()
-    assert mock_print.call_count == 1
+    assert mock_log_event.call_count == 1
 
 
 @pytest.mark.asyncio
@@ -218,7 +239,7 @@ async def test_prompt(mock_is_valid_input, mock_summarize_conversation, mock_con
         # summarize_conversation() and call_openai_api() should be called
         bot.max_history_tokens = 1
         await prompt(ctx, text='Hello bot')
-        mock_summarize_conversation.assert_awaited_once_with('Hello bot')
+        mock_summarize_conversation.assert_awaited_once_with('Hello bot', role=bot.role)
         mock_summarize_conversation.reset_mock()
         mock_call_openai_api.assert_awaited_once()
         mock_call_openai_api.reset_mock()
@@ -287,27 +308,27 @@ async def test_random_role(mock_context_send, mock_set_random_role, mock_clear_h
 
 
 @pytest.mark.asyncio
-@patch('builtins.print', autospec=True)
+@patch('discordbot.log_event', autospec=True)
 @asynctest.patch('discordbot.call_openai_api', autospec=True, return_value='description')
-async def test_set_random_role(mock_call_openai_api, mock_print):
+async def test_set_random_role(mock_call_openai_api, mock_log_event):
     """
-    set_random_role() should print a message, call call_openai_api(), and return the response
+    set_random_role() should log a message, call call_openai_api(), and return the response
     """
     bot.role = 'old role'
 
     response = await set_random_role()
 
-    mock_print.assert_called_once()
-    mock_print.reset_mock()
+    mock_log_event.assert_called_once_with('role', role='description')
+    mock_log_event.reset_mock()
     mock_call_openai_api.assert_called_once()
     mock_call_openai_api.reset_mock()
     assert response == mock_call_openai_api.return_value
 
-    # If there's an Exception, print() should be called again
+    # If there's an Exception, an error should be logged
     mock_call_openai_api.side_effect = [Exception('Oh noes!')]
     await set_random_role()
-    assert mock_print.call_count == 2
-    mock_print.reset_mock()
+    mock_log_event.assert_called_once_with('role_error', logging.ERROR, error='Oh noes!')
+    mock_log_event.reset_mock()
 
 
 @pytest.mark.asyncio
@@ -446,6 +467,7 @@ async def test_summarize_conversation():
             prompt_text='Summarize the following conversation:\n' + conversation,
             max_tokens=1000,
             temperature=0.7,
+            role=None,
         )
 
 
@@ -512,3 +534,546 @@ async def test_on_message(mock_bot_process_commands, ctx):
     args, kwargs = mock_bot_process_commands.call_args
     assert args[1].content == '!prompt hey there'
     mock_bot_process_commands.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_run_job():
+    """
+    run_job() should dispatch a job to the function for its kind
+    """
+    with asynctest.patch(
+            'discordbot.call_openai_api', new=CoroutineMock(return_value='Test answer')
+    ) as mock_call_openai_api:
+        result = await run_job({'kind': 'prompt', 'args': {
+            'text': 'Hello bot', 'conversation': '', 'role': 'Tim the Enchanter',
+            'max_tokens': 10, 'temperature': 0.7, 'max_history_tokens': 100,
+        }})
+        assert result == {'answer': 'Test answer', 'conversation': 'User: Hello bot\nAI: Test answer\n'}
+        _, kwargs = mock_call_openai_api.call_args
+        assert kwargs['role'] == 'Tim the Enchanter'
+
+    with asynctest.patch('discordbot.get_openai_image', return_value='https://www.example.com/image.jpg'):
+        result = await run_job({'kind': 'image', 'args': {'search_term': 'cuddly gray rat'}})
+        assert result == 'https://www.example.com/image.jpg'
+
+    with asynctest.patch('discordbot.summarize_conversation', return_value='Test summary') as mock_summarize:
+        result = await run_job({'kind': 'summarize', 'args': {'conversation': 'Hello bot', 'role': 'rat'}})
+        assert result == 'Test summary'
+        mock_summarize.assert_awaited_once_with('Hello bot', role='rat')
+
+    with asynctest.patch('discordbot.call_openai_api', new=CoroutineMock(return_value='A role')) as mock_call:
+        result = await run_job({'kind': 'complete', 'args': {
+            'prompt_text': 'Make up a role', 'max_tokens': 10, 'temperature': 0.7, 'role': 'rat',
+        }})
+        assert result == 'A role'
+        mock_call.assert_awaited_once_with(prompt_text='Make up a role', max_tokens=10, temperature=0.7, role='rat')
+
+    with pytest.raises(ValueError):
+        await run_job({'kind': 'dance', 'args': {}})
+
+
+@pytest.mark.asyncio
+async def test_local_broker():
+    """
+    LocalBroker.submit() should run the job with its handler
+    """
+    handler = CoroutineMock(return_value='done')
+    broker = LocalBroker(handler)
+    assert await broker.submit({'kind': 'image', 'args': {}}) == 'done'
+    handler.assert_awaited_once_with({'kind': 'image', 'args': {}})
+
+
+async def wait_for_worker(broker):
+    while not broker.workers:
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_socket_broker(tmp_path):
+    """
+    SocketBroker.submit() should hand jobs to a worker and return its result, or raise its error
+    """
+    async def handler(job):
+        if job['kind'] == 'fail':
+            raise Exception('Oh noes!')
+        return job['args']['text'].upper()
+
+    broker = SocketBroker(str(tmp_path / 'jobs.sock'))
+    await broker.start()
+    worker = asyncio.create_task(run_worker(broker.path, handler))
+    try:
+        await wait_for_worker(broker)
+        results = await asyncio.gather(*[
+            broker.submit({'kind': 'prompt', 'args': {'text': f'hello {i}'}}) for i in range(3)
+        ])
+        assert results == ['HELLO 0', 'HELLO 1', 'HELLO 2']
+
+        with pytest.raises(JobError, match='Oh noes!'):
+            await broker.submit({'kind': 'fail', 'args': {}})
+    finally:
+        worker.cancel()
+        await broker.close()
+
+
+def test_slash_commands():
+    """
+    prompt, image, role, temp, tokens, forget and summarize should be available as slash commands
+    """
+    names = {command.name for command in bot.tree.get_commands()}
+    assert names == {'prompt', 'image', 'role', 'temp', 'tokens', 'forget', 'summarize'}
+
+
+@pytest.mark.asyncio
+async def test_slash_command_defers():
+    """
+    Slash commands should be acknowledged with defer() before the follow-up response is sent
+    """
+    interaction_ctx = MagicMock()
+    calls = []
+    interaction_ctx.defer = CoroutineMock(side_effect=lambda: calls.append('defer'))
+    interaction_ctx.send = CoroutineMock(side_effect=lambda *args, **kwargs: calls.append('send'))
+
+    await forget(interaction_ctx)
+    assert calls == ['defer', 'send']
+
+
+@pytest.mark.asyncio
+@asynctest.patch('discord.ext.commands.Bot.process_commands', autospec=True)
+async def test_on_message_without_message_content(mock_bot_process_commands, ctx):
+    """
+    The bot should only receive guild messages with the message content intent, and always handle DMs
+    """
+    assert bot.intents.guild_messages == bot.intents.message_content
+    assert bot.intents.dm_messages
+
+    ctx.message.author = MagicMock(ClientUser)
+    ctx.message.guild = None
+    ctx.message.channel = MagicMock(DMChannel)
+    ctx.message.content = 'hey there'
+    await on_message(ctx.message)
+    args, kwargs = mock_bot_process_commands.call_args
+    assert args[1].content == '!prompt hey there'
+
+
+@pytest.mark.asyncio
+@asynctest.patch('discordbot.bot.broker')
+@asynctest.patch('discordbot.bot.tree.sync', new_callable=CoroutineMock)
+async def test_setup_hook(mock_sync, mock_broker):
+    """
+    setup_hook() should start the broker, and only register the slash commands with Discord when asked to
+    """
+    mock_broker.start = CoroutineMock()
+    await setup_hook()
+    mock_broker.start.assert_awaited_once()
+    mock_sync.assert_not_awaited()
+
+    with patch('discordbot.SYNC_COMMANDS', True):
+        await setup_hook()
+    mock_sync.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+@asynctest.patch('discord.ext.commands.Context.send', autospec=True)
+@asynctest.patch('discordbot.profile', autospec=True, return_value='profiles/profile.txt')
+async def test_profile_bot(mock_profile, mock_context_send, ctx):
+    """
+    profile_bot() should profile for a valid number of seconds, and send the path of the dump
+    """
+    await profile_bot(ctx, 0)
+    args, _ = mock_context_send.call_args
+    assert 'Invalid number of seconds' in args[1]
+    mock_profile.assert_not_called()
+    mock_context_send.reset_mock()
+
+    await profile_bot(ctx, 10)
+    mock_profile.assert_called_once_with(10, 'profiles')
+    args, _ = mock_context_send.call_args
+    assert args[1] == 'Profile written to profiles/profile.txt.'
+
+
+@pytest.mark.asyncio
+@patch('profiling.log_event', autospec=True)
+async def test_profile(mock_log_event, tmp_path):
+    """
+    profile() should write a dump and log its path, or log why it couldn't
+    """
+    path = await profile(0.01, str(tmp_path / 'profiles'))
+    assert os.path.exists(path)
+    mock_log_event.assert_called_once_with('profile_written', path=path)
+    mock_log_event.reset_mock()
+
+    (tmp_path / 'file').write_text('')
+    with pytest.raises(OSError):
+        await profile(0.01, str(tmp_path / 'file'))
+    args, kwargs = mock_log_event.call_args
+    assert args == ('profile_error', logging.ERROR)
+    assert kwargs['directory'] == str(tmp_path / 'file')
+
+
+def test_sampling_profiler(tmp_path):
+    """
+    SamplingProfiler should write collapsed stacks with a sample count
+    """
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    time.sleep(0.05)
+    profiler.stop()
+
+    path = tmp_path / 'profile.txt'
+    profiler.write(path)
+    lines = path.read_text().splitlines()
+    assert any('MainThread;' in line and 'test_sampling_profiler' in line for line in lines)
+    stack, count = lines[0].rsplit(' ', 1)
+    assert int(count) > 0
+
+
+@pytest.mark.asyncio
+@patch('profiling.log_event', autospec=True)
+async def test_slow_callback_detector(mock_log_event):
+    """
+    SlowCallbackDetector should log the stack of a callback that blocks the loop
+    """
+    detector = SlowCallbackDetector(asyncio.get_running_loop(), 0.05)
+    detector.start()
+    await asyncio.sleep(0.1)
+    mock_log_event.assert_not_called()
+
+    time.sleep(0.3)
+    await asyncio.sleep(0)
+    detector.stop()
+    mock_log_event.assert_called_once()
+    _, kwargs = mock_log_event.call_args
+    assert 'test_slow_callback_detector' in kwargs['stack']
+
+
+@pytest.mark.asyncio
+@patch('profiling.log_event', autospec=True)
+async def test_slow_callback_detector_near_threshold(mock_log_event):
+    """
+    SlowCallbackDetector should report a block just over the threshold with its duration, and not one under it
+    """
+    detector = SlowCallbackDetector(asyncio.get_running_loop(), 0.2)
+    detector.start()
+    await asyncio.sleep(0.05)
+    time.sleep(0.1)
+    await asyncio.sleep(0.1)
+    mock_log_event.assert_not_called()
+
+    time.sleep(0.25)
+    await asyncio.sleep(0.1)
+    detector.stop()
+    mock_log_event.assert_called_once()
+    _, kwargs = mock_log_event.call_args
+    assert 0.2 < kwargs['seconds'] <= 0.27
+
+
+@pytest.mark.asyncio
+@asynctest.patch('discordbot.send_images', autospec=True)
+@asynctest.patch('discord.ext.commands.Context.send', autospec=True)
+async def test_image_count_and_styles(mock_context_send, mock_send_images, ctx):
+    """
+    image() should send xN images, cycling through the styles separated by |
+    """
+    await image(ctx, prompt='x3 cuddly gray rat')
+    mock_send_images.assert_called_once_with(ctx, ['cuddly gray rat'] * 3)
+    mock_send_images.reset_mock()
+
+    await image(ctx, prompt='cuddly gray rat | watercolor | pixel art')
+    mock_send_images.assert_called_once_with(ctx, ['cuddly gray rat, watercolor', 'cuddly gray rat, pixel art'])
+    mock_send_images.reset_mock()
+
+    await image(ctx, prompt='x3 cuddly gray rat | watercolor | pixel art')
+    mock_send_images.assert_called_once_with(
+        ctx, ['cuddly gray rat, watercolor', 'cuddly gray rat, pixel art', 'cuddly gray rat, watercolor']
+    )
+    mock_send_images.reset_mock()
+
+    # Numbers without x are search terms
+    await image(ctx, prompt='1984 dystopian city')
+    mock_send_images.assert_called_once_with(ctx, ['1984 dystopian city'])
+    mock_send_images.reset_mock()
+
+    await image(ctx, prompt='3 little pigs')
+    mock_send_images.assert_called_once_with(ctx, ['3 little pigs'])
+    mock_send_images.reset_mock()
+
+    # Too many images: error message should be sent
+    await image(ctx, prompt='x100 cuddly gray rat')
+    mock_send_images.assert_not_called()
+    args, _ = mock_context_send.call_args
+    assert 'Invalid number of images' in args[1]
+
+
+@pytest.mark.asyncio
+@asynctest.patch('discord.ext.commands.Context.send', autospec=True)
+async def test_send_images(mock_context_send, ctx):
+    """
+    send_images() should generate images concurrently, send each one when it's done, and report failures
+    """
+    finished = []
+
+    async def fake_send_image(ctx, search_term):
+        await asyncio.sleep(0.05 if search_term == 'slow' else 0)
+        if search_term == 'broken':
+            raise Exception('Oh noes!')
+        finished.append(search_term)
+
+    with asynctest.patch('discordbot.send_image', new=fake_send_image):
+        await send_images(ctx, ['slow', 'fast', 'broken'])
+
+    assert finished == ['fast', 'slow']
+    mock_context_send.assert_called_once_with(ctx, "Couldn't send 1 of 3 images: Oh noes!")
+
+
+def prompt_ctx(user_id, message_id):
+    """
+    A context for a prompt of user_id in message message_id
+    """
+    prompt_context = MagicMock()
+    prompt_context.message.author.id = user_id
+    prompt_context.message.id = message_id
+    prompt_context.interaction = None
+    prompt_context.defer = CoroutineMock()
+    prompt_context.send = CoroutineMock()
+    return prompt_context
+
+
+@pytest.mark.asyncio
+async def test_prompt_cancellation():
+    """
+    A prompt should be cancelled by a new prompt, forget() and deleting its message,
+    and its answer should never end up in the history
+    """
+    answers = {}
+
+    async def fake_call_openai_api(prompt_text, **kwargs):
+        answers[prompt_text] = asyncio.get_running_loop().create_future()
+        return await answers[prompt_text]
+
+    with asynctest.patch('discordbot.call_openai_api', new=fake_call_openai_api):
+        bot.conversation_history['456'] = ''
+        bot.max_history_tokens = 4096
+
+        # A new prompt supersedes the old one
+        old_ctx, new_ctx = prompt_ctx('456', 1), prompt_ctx('456', 2)
+        old_prompt = asyncio.create_task(prompt(old_ctx, text='old'))
+        await asyncio.sleep(0)
+        new_prompt = asyncio.create_task(prompt(new_ctx, text='new'))
+        await asyncio.sleep(0)
+        await asyncio.wait([old_prompt])
+        assert old_prompt.cancelled()
+        answers['User: new\nAI:'].set_result('new answer')
+        await new_prompt
+        assert bot.conversation_history['456'] == 'User: new\nAI: new answer\n'
+        old_ctx.send.assert_not_called()
+        new_ctx.send.assert_awaited_once_with('new answer')
+
+        # forget() cancels the prompt
+        forget_ctx = prompt_ctx('456', 3)
+        pending = asyncio.create_task(prompt(prompt_ctx('456', 4), text='forgotten'))
+        await asyncio.sleep(0)
+        await forget(forget_ctx)
+        await asyncio.wait([pending])
+        assert pending.cancelled()
+        assert bot.conversation_history['456'] == ''
+
+        # Deleting the message cancels the prompt
+        pending = asyncio.create_task(prompt(prompt_ctx('456', 5), text='deleted'))
+        await asyncio.sleep(0)
+        await on_raw_message_delete(MagicMock(message_id=5))
+        await asyncio.wait([pending])
+        assert pending.cancelled()
+        assert bot.conversation_history['456'] == ''
+        assert '456' not in bot.in_flight
+        assert not bot.in_flight_users
+
+        # Once the answer is in the history, a new prompt doesn't cut off sending it
+        sending_ctx = prompt_ctx('456', 6)
+        sent = asyncio.Event()
+
+        async def slow_send(*args):
+            await sent.wait()
+        sending_ctx.send = CoroutineMock(side_effect=slow_send)
+        sending = asyncio.create_task(prompt(sending_ctx, text='sending'))
+        await asyncio.sleep(0)
+        answers['User: sending\nAI:'].set_result('sent answer')
+        await asyncio.sleep(0.01)
+        pending = asyncio.create_task(prompt(prompt_ctx('456', 7), text='next'))
+        await asyncio.sleep(0)
+        sent.set()
+        await sending
+        sending_ctx.send.assert_awaited_once_with('sent answer')
+        pending.cancel()
+        await asyncio.wait([pending])
+
+        # A cancelled slash command gets a reply, instead of thinking until the interaction expires
+        slash_ctx = prompt_ctx('456', 8)
+        slash_ctx.interaction = MagicMock()
+        pending = asyncio.create_task(prompt(slash_ctx, text='slash'))
+        await asyncio.sleep(0)
+        await forget(prompt_ctx('456', 9))
+        await asyncio.wait([pending])
+        assert pending.cancelled()
+        slash_ctx.send.assert_awaited_once_with("This prompt was cancelled.")
+        assert not bot.in_flight
+        assert not bot.in_flight_users
+
+
+@pytest.mark.asyncio
+async def test_socket_broker_without_workers(tmp_path):
+    """
+    SocketBroker.submit() should fail right away without workers, and fail queued jobs when the last worker leaves
+    """
+    broker = SocketBroker(str(tmp_path / 'jobs.sock'))
+    await broker.start()
+    try:
+        with pytest.raises(JobError, match='No workers'):
+            await broker.submit({'kind': 'prompt', 'args': {}})
+
+        async def handler(job):
+            await asyncio.Event().wait()
+
+        worker = asyncio.create_task(run_worker(broker.path, handler, concurrency=1))
+        await wait_for_worker(broker)
+        running = asyncio.create_task(broker.submit({'kind': 'prompt', 'args': {}}))
+        queued = asyncio.create_task(broker.submit({'kind': 'prompt', 'args': {}}))
+        await asyncio.sleep(0.05)
+        worker.cancel()
+        for job in (running, queued):
+            with pytest.raises(JobError, match='No workers'):
+                await asyncio.wait_for(job, 1)
+    finally:
+        await broker.close()
+
+
+@pytest.mark.asyncio
+async def test_socket_broker_concurrency(tmp_path):
+    """
+    A worker should run up to its concurrency of jobs at once, and no more
+    """
+    running = 0
+    most_running = 0
+
+    async def handler(job):
+        nonlocal running, most_running
+        running += 1
+        most_running = max(most_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return job['args']['text']
+
+    broker = SocketBroker(str(tmp_path / 'jobs.sock'))
+    await broker.start()
+    worker = asyncio.create_task(run_worker(broker.path, handler, concurrency=3))
+    try:
+        await wait_for_worker(broker)
+        results = await asyncio.wait_for(asyncio.gather(*[
+            broker.submit({'kind': 'prompt', 'args': {'text': str(i)}}) for i in range(7)
+        ]), 1)
+        assert results == [str(i) for i in range(7)]
+        assert most_running == 3
+    finally:
+        worker.cancel()
+        await broker.close()
+
+
+@pytest.mark.asyncio
+async def test_socket_broker_cancel(tmp_path):
+    """
+    Cancelling a job submitted to SocketBroker should cancel it in the worker, and the worker should take new jobs
+    """
+    started = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def handler(job):
+        if job['kind'] == 'hang':
+            started.set()
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        return 'done'
+
+    broker = SocketBroker(str(tmp_path / 'jobs.sock'))
+    await broker.start()
+    worker = asyncio.create_task(run_worker(broker.path, handler))
+    try:
+        await wait_for_worker(broker)
+        hanging = asyncio.create_task(broker.submit({'kind': 'hang', 'args': {}}))
+        await started.wait()
+        hanging.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+
+        assert await asyncio.wait_for(broker.submit({'kind': 'prompt', 'args': {}}), 1) == 'done'
+    finally:
+        worker.cancel()
+        await broker.close()
+
+
+def test_truncate():
+    """
+    truncate() should keep the start and end of long strings, and leave everything else alone
+    """
+    assert truncate('short', 10) == 'short'
+    assert truncate(12345, 2) == 12345
+    assert truncate('a' * 5 + 'b' * 10 + 'c' * 5, 10) == 'aaaaa...[10 chars]...ccccc'
+
+
+def test_json_formatter():
+    """
+    JsonFormatter should format the event and its fields as JSON, truncating large fields
+    """
+    record = logging.LogRecord('discordbot', logging.INFO, __file__, 1, 'conversation', None, None)
+    record.fields = {'user': '123', 'conversation': 'x' * 10000}
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['level'] == 'INFO'
+    assert entry['event'] == 'conversation'
+    assert entry['user'] == '123'
+    assert len(entry['conversation']) < 10000
+
+
+def test_log_event():
+    """
+    log_event() should write JSON lines from a background thread, and skip disabled levels and sampled out events
+    """
+    root_level = logging.getLogger().level
+    stream = io.StringIO()
+    listener = setup_logging('INFO', stream)
+    try:
+        log_event('connected', user='bot')
+        log_event('conversation', logging.DEBUG, conversation='Hello bot')
+        with patch.dict('logs.LOG_SAMPLE_RATES', {'connected': 0.0}):
+            log_event('connected', user='sampled out')
+    finally:
+        listener.stop()
+
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 1
+    entry = json.loads(lines[0])
+    assert entry['event'] == 'connected'
+    assert entry['level'] == 'INFO'
+    assert entry['user'] == 'bot'
+    # Stopping undoes the setup
+    assert listener.queue_handler not in logging.getLogger().handlers
+    assert logging.getLogger().level == root_level
+    assert logging.getLogger('discordbot').level == logging.NOTSET
+
+
+def test_log_levels_and_drops():
+    """
+    LOG_LEVEL should only apply to the bot's events, and stopping should log how many events were dropped
+    """
+    stream = io.StringIO()
+    listener = setup_logging('DEBUG', stream)
+    try:
+        logging.getLogger('discord.gateway').debug('gateway traffic')
+        logging.getLogger('discord.client').info('logging in')
+        log_event('summarized_history', logging.DEBUG, length=100)
+        listener.queue_handler.dropped = 3
+    finally:
+        listener.stop()
+
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [entry['event'] for entry in events] == ['logging in', 'summarized_history', 'log_events_dropped']
+    assert events[-1]['count'] == 3